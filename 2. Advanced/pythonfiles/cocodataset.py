@@ -1,61 +1,88 @@
 import os
+from collections import OrderedDict
 
 import torch
 from torchvision.datasets import CocoDetection
+from torchvision.io import read_file, decode_jpeg, ImageReadMode
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import numpy as np
 from PIL import Image
+
+
+def get_valid_ids(coco, ids):
+    # drop images without objects or with any bbox width/height <= 1,
+    # checked over every annotation at once
+    anns = list(coco.anns.values())
+    ann_img_ids = np.array([ann['image_id'] for ann in anns], dtype=np.int64)
+    bboxes = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)
+    invalid = (bboxes[:, 2] <= 1) | (bboxes[:, 3] <= 1)
+    
+    with_anno = set(np.unique(ann_img_ids).tolist())
+    with_invalid = set(np.unique(ann_img_ids[invalid]).tolist())
+    return [img_id for img_id in ids if img_id in with_anno and img_id not in with_invalid]
+
    
 class myCocoDetection(CocoDetection):
     def __init__(
-        self, root, annFile, transform, remove_invalid_data=True):
+        self, root, annFile, transform, remove_invalid_data=True, cache_size=0, decode_device=None):
         super(myCocoDetection, self).__init__(root, annFile)
         
         if remove_invalid_data:
-            ids = []
-            for img_id in self.ids:
-                ann_ids = self.coco.getAnnIds(imgIds=img_id)
-                anno = self.coco.loadAnns(ann_ids)
-                if self.is_valid_data(anno):
-                    ids.append(img_id)
-            self.ids = ids
+            self.ids = get_valid_ids(self.coco, self.ids)
             
         self.transform = transform
+        self.cache_size = cache_size
+        self._image_cache = OrderedDict()
+        self.decode_device = decode_device
         
-    def is_valid_data(self, anno):
-        if len(anno) == 0:
-            return False
-        for obj in anno:
-            for o in obj['bbox'][2:]:
-                if o <= 1:
-                    return False
-        return True
+    def _read_image(self, idx: int):
+        # decoded RGB array, kept in a per-worker LRU when cache_size > 0
+        if idx in self._image_cache:
+            self._image_cache.move_to_end(idx)
+            return self._image_cache[idx]
+        
+        path = self.coco.loadImgs(idx)[0]["file_name"]
+        image = np.asarray(Image.open(os.path.join(self.root, path)).convert("RGB"))
+        if self.cache_size > 0:
+            self._image_cache[idx] = image
+            if len(self._image_cache) > self.cache_size:
+                self._image_cache.popitem(last=False)
+        return image
+    
+    def _decode_image(self, idx: int):
+        # libjpeg-turbo on cpu, nvjpeg on cuda (main process only, num_workers=0);
+        # returns the same float CHW tensor in [0, 1] as ToTensor
+        path = self.coco.loadImgs(idx)[0]["file_name"]
+        data = read_file(os.path.join(self.root, path))
+        image = decode_jpeg(data, mode=ImageReadMode.RGB, device=self.decode_device)
+        return image.float().div(255)
     
     def _load_image(self, idx: int):
+        if self.decode_device is not None:
+            return self._decode_image(idx)
+        if self.cache_size > 0:
+            return Image.fromarray(self._read_image(idx))
         path = self.coco.loadImgs(idx)[0]["file_name"]
         return Image.open(os.path.join(self.root, path)).convert("RGB")
     
     def _load_target(self, idx):
-        return self.coco.loadAnns(self.coco.getAnnIds(idx))
+        return self.coco.imgToAnns.get(idx, [])
     
     def __getitem__(self, index: int):
         idx = self.ids[index]
         image = self._load_image(idx)
         target = self._load_target(idx)
         
-        bboxes, labels = [], []
-        for obj in target:
-            bbox = [obj['bbox'][0],
-                    obj['bbox'][1],
-                    obj['bbox'][0] + obj['bbox'][2],
-                    obj['bbox'][1] + obj['bbox'][3]]
-            bboxes.append(bbox)
-            labels.append(obj['category_id'])
+        raw = np.array([obj['bbox'] for obj in target], dtype=np.float32).reshape(-1, 4)
+        bboxes = np.concatenate([raw[:, :2], raw[:, :2] + raw[:, 2:]], axis=1)
+        labels = np.fromiter((obj['category_id'] for obj in target), dtype=np.int64, count=len(target))
         
         if self.transform:
-            image = self.transform(image)
+            # images from _decode_image are already tensors
+            if self.decode_device is None:
+                image = self.transform(image)
             bboxes = self.transform(np.array(bboxes)).reshape(-1, 4)
             
             targets ={}
@@ -1,4 +1,7 @@
 import os
+import math
+
+import torch
 from torchvision.datasets import CIFAR10, CIFAR100, MNIST, ImageFolder
 
 def get_dataset(name, train_transform=None, test_transform=None):
@@ -39,6 +42,40 @@ def get_dataset(name, train_transform=None, test_transform=None):
         
     return train_set, test_set
 
+
+class DeviceLoader:
+    # Small datasets (mnist, cifar) fit in GPU memory, so decode them once and
+    # index batches on the device instead of going through DataLoader workers every epoch
+    def __init__(self, dataset, batch_size, device, shuffle=False, hflip=False):
+        images, labels = zip(*[dataset[i] for i in range(len(dataset))])
+        self.images = torch.stack(images).to(device)
+        self.labels = torch.tensor(labels).to(device)
+        
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.hflip = hflip
+        
+    def __len__(self):
+        return math.ceil(len(self.labels) / self.batch_size)
+    
+    def __iter__(self):
+        n = len(self.labels)
+        if self.shuffle:
+            indices = torch.randperm(n, device=self.device)
+        else:
+            indices = torch.arange(n, device=self.device)
+            
+        for start in range(0, n, self.batch_size):
+            batch = indices[start:start+self.batch_size]
+            images = self.images[batch]
+            if self.hflip:
+                # per-sample RandomHorizontalFlip, since the cached images are not augmented
+                flip = torch.rand(len(batch), device=self.device) < 0.5
+                images = torch.where(flip.view(-1, 1, 1, 1), images.flip(3), images)
+                
+            yield images, self.labels[batch]
+
 if __name__ == '__main__':
     data_path = get_dataset('catdog')
     print(data_path)
\ No newline at end of file
@@ -4,10 +4,16 @@ from time import strftime, gmtime
 import datetime
 import argparse
 import random
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.cuda.amp import autocast, GradScaler
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data import DataLoader, Subset
 import torchvision
 import torchvision.transforms as transforms
@@ -20,8 +26,8 @@ import matplotlib.pyplot as plt
 
 # from model import ResNet, Bottleneck, BasicBlock
 from models import get_model
-from datasets import get_dataset
-from utils import save_result, make_folder
+from datasets import get_dataset, DeviceLoader
+from utils import save_result, make_folder, fast_optim_kwargs
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -40,15 +46,20 @@ def parse_opt():
     parser.add_argument('--in_channels', help='Channels of input Image', default=3, type=int)
     parser.add_argument('--num_classes', help='Number of Classes', default=10, type=int)
     parser.add_argument('--pretrained', help='Transfer Learning', action='store_true')
-    parser.add_argument('--batch_norm', help='Using Batch Normalization', default=False, type=bool)
+    parser.add_argument('--batch_norm', help='Using Batch Normalization', default=False, action=argparse.BooleanOptionalAction)
     parser.add_argument('--train_batch_size', help='Batch size of Training dataset', default=256, type=int)
     parser.add_argument('--test_batch_size', help='Batch size of Testing dataset', default=128, type=int)
+    parser.add_argument('--num_workers', help='Number of DataLoader workers', default=8, type=int)
+    parser.add_argument('--accum_steps', help='Number of Gradient Accumulation steps', default=1, type=int)
     parser.add_argument('--epoch', help='Size of Epoch', default=20, type=int)
     parser.add_argument('--lr', help='Learning Rate', default=0.01, type=float)
     parser.add_argument('--momentum', help='Momentum', default=0.9, type=float)
-    parser.add_argument('--cuda', help='Using GPU', default=True, type=bool)
+    parser.add_argument('--cuda', help='Using GPU', default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument('--amp', help='Mixed Precision Training', action='store_true')
+    parser.add_argument('--compile', help='Compile model with torch.compile', action='store_true')
+    parser.add_argument('--preload', help='Keep the whole dataset in device memory (mnist, cifar)', action='store_true')
     parser.add_argument('--resume', help='Start from checkpoint', default='', type=str)
-    parser.add_argument('--save_result', help='Save Result of Train&Test', default=True, type=bool)
+    parser.add_argument('--save_result', help='Save Result of Train&Test', default=True, action=argparse.BooleanOptionalAction)
     parser.add_argument('--save_folder', help='Directory of Saving weight', default='train0', type=str)
     parser.add_argument('--testing', help='Testing Code', action='store_true')
     opt = parser.parse_args()
@@ -56,11 +67,11 @@ def parse_opt():
     return opt
 
 
-def train(model, dataloader, optimizer, loss_func, device, start_epoch, scheduler, e):
+def train(model, dataloader, optimizer, scaler, loss_func, device, mean, std, start_epoch, scheduler, e):
     print(f'EPOCH[{e+1}/{start_epoch+opt.epoch}] Training....')
     model.train()
-    iter_loss = []
-    corrects = 0
+    loss_sum = torch.zeros((), device=device)
+    correct_sum = torch.zeros((), device=device, dtype=torch.long)
     data_size = 0
     
     train_acc1 = torchmetrics.Accuracy(num_classes=opt.num_classes).to(device)
@@ -68,32 +79,49 @@ def train(model, dataloader, optimizer, loss_func, device, start_epoch, schedule
     # train_precision = torchmetrics.Precision(num_classes=10, multiclass=True).to(device)
     # train_recall = torchmetrics.Recall(num_classes=10, multiclass=True).to(device)
     
+    n_iter = len(dataloader)
     for i, (images, labels) in enumerate(dataloader):
         start = time.time()
         
-        images, labels = images.to(device), labels.to(device)
+        images = images.to(device, non_blocking=True, memory_format=torch.channels_last)
+        images = (images - mean) / std
+        labels = labels.to(device, non_blocking=True)
         data_size += images.shape[0]
         
-        optimizer.zero_grad()
-        outputs = model(images)
-        loss = loss_func(outputs, labels)
-        loss.backward()
-        optimizer.step()
+        # skip DDP all-reduce on micro steps; no_sync must cover forward as well as backward
+        is_last_micro = ((i+1) % opt.accum_steps == 0) or ((i+1) == n_iter)
+        # the last window of an epoch can hold fewer than accum_steps batches
+        window = min(opt.accum_steps, n_iter - (i // opt.accum_steps) * opt.accum_steps)
+        if hasattr(model, 'no_sync') and not is_last_micro:
+            sync_context = model.no_sync()
+        else:
+            sync_context = contextlib.nullcontext()
+        
+        with sync_context:
+            with autocast(enabled=opt.amp):
+                outputs = model(images)
+                loss = loss_func(outputs, labels)
+            scaler.scale(loss / window).backward()
+            
+        if is_last_micro:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
         train_acc1(outputs, labels)
         # train_acc5(outputs, labels)
         # train_precision(outputs, labels)
         # train_recall(outputs, labels)
 
-        iter_loss.append(loss.item())
-        corrects += sum(outputs.argmax(axis=1) == labels).item()
+        loss_sum += loss.detach()
+        correct_sum += (outputs.argmax(1) == labels).sum()
 
         end = time.time()
-        if ((i+1) % 40 == 0) or ((i+1) == len(dataloader)) :
-            times = (end-start)*40 if not (i+1) == len(dataloader) else (end-start)*i
-            print(f'Iter[{i+1}/{len(dataloader)}]'\
-                  f'--- Loss: {sum(iter_loss)/data_size:0.4f}'\
-                #   f' --- Accuracy: {corrects/data_size:0.2f}'\
+        if ((i+1) % 40 == 0) or ((i+1) == n_iter) :
+            times = (end-start)*40 if not (i+1) == n_iter else (end-start)*i
+            print(f'Iter[{i+1}/{n_iter}]'\
+                  f'--- Loss: {loss_sum.item()/data_size:0.4f}'\
+                #   f' --- Accuracy: {correct_sum.item()/data_size:0.2f}'\
                   f' --- Accuracy1: {train_acc1.compute():0.2f}'\
                 #   f' --- Accuracy5: {train_acc5.compute():0.2f}'\
                 #   f' --- Precision: {train_precision.compute():0.2f}'\
@@ -101,46 +129,58 @@ def train(model, dataloader, optimizer, loss_func, device, start_epoch, schedule
                   f'--- Time:{strftime("%H:%M:%S", gmtime(times))}'\
                   f'--- LR: {scheduler.get_lr()[0]:0.4f}')
             
-    return [sum(iter_loss)/data_size, train_acc1.compute().cpu()]
+    return [loss_sum.item()/data_size, train_acc1.compute().cpu()]
 
 
 
-def test(model, dataloader, loss_func, device, start_epoch, e):
+def test(model, dataloader, loss_func, device, mean, std, start_epoch, e):
     print(f'EPOCH[{e+1}/{start_epoch+opt.epoch}] Teseting....')
     model.eval()
-    iter_loss = []
-    corrects = 0
+    loss_sum = torch.zeros((), device=device)
+    correct_sum = torch.zeros((), device=device, dtype=torch.long)
     
     test_metrics = torchmetrics.Accuracy(num_classes=opt.num_classes).to(device)
     
-    with torch.no_grad():
+    n_iter = len(dataloader)
+    with torch.inference_mode():
         data_size = 0
         for i, (images, labels) in enumerate(dataloader):
-            images, labels = images.to(device), labels.to(device)
+            images = images.to(device, non_blocking=True, memory_format=torch.channels_last)
+            images = (images - mean) / std
+            labels = labels.to(device, non_blocking=True)
             data_size += images.shape[0]
             
-            outputs = model(images)
-            loss = loss_func(outputs, labels)
+            with autocast(enabled=opt.amp):
+                outputs = model(images)
+                loss = loss_func(outputs, labels)
             
             test_metrics(outputs, labels)
             
-            iter_loss.append(loss.item())
-            corrects += sum(outputs.argmax(axis=1) == labels).item()
+            loss_sum += loss.detach()
+            correct_sum += (outputs.argmax(1) == labels).sum()
     
-    print(f'Iter[{i+1}/{len(dataloader)}]' \
-          f'--- Loss: {sum(iter_loss)/data_size:0.4}'\
-        #   f'--- Accuracy: {corrects/data_size:0.2}'\
+    print(f'Iter[{i+1}/{n_iter}]' \
+          f'--- Loss: {loss_sum.item()/data_size:0.4}'\
+        #   f'--- Accuracy: {correct_sum.item()/data_size:0.2}'\
           f'--- Accuracy: {test_metrics.compute():0.4f}')
     
-    return [sum(iter_loss)/data_size, test_metrics.compute().cpu()]
+    return [loss_sum.item()/data_size, test_metrics.compute().cpu()]
             
         
 def main(opt):
     
+    # Distributed (launched with torchrun --nproc_per_node=N)
+    distributed = 'LOCAL_RANK' in os.environ
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if distributed:
+        dist.init_process_group(backend='nccl')
+        torch.cuda.set_device(local_rank)
+    is_main = (not distributed) or dist.get_rank() == 0
+    
     # make folder
     base_path = 'result'
     os.makedirs(base_path, exist_ok=True)
-    result_path = make_folder(base_path, opt.save_folder)      
+    result_path = make_folder(base_path, opt.save_folder) if is_main else None
     
     # Dataset
     print(f'Preparing Dataset....{opt.dataset}')
@@ -148,13 +188,11 @@ def main(opt):
         transforms.Resize((32,32)),
         # transforms.RandomHorizontalFlip(),
         transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406],std=[0.229, 0.224, 0.225])
     ])
     
     test_transform = transforms.Compose([
         transforms.Resize((32,32)),
         transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406],std=[0.229, 0.224, 0.225])
     ])
     
     train_set, test_set = get_dataset(opt.dataset, train_transform, test_transform)
@@ -162,27 +200,49 @@ def main(opt):
         train_set = Subset(train_set, range(opt.train_batch_size))
         test_set = Subset(test_set, range(opt.test_batch_size))
     
-    # Load Dataset
-    train_loader = DataLoader(train_set, batch_size=opt.train_batch_size, shuffle=True)
-    test_loader = DataLoader(test_set, batch_size=opt.test_batch_size, shuffle=False)
-
-     
     # GPU
-    device = 'cuda' if (torch.cuda.is_available() and opt.cuda) else 'cpu'
+    if distributed:
+        device = f'cuda:{local_rank}'
+        torch.backends.cudnn.benchmark = True
+    elif torch.cuda.is_available() and opt.cuda:
+        device = 'cuda'
+        torch.backends.cudnn.benchmark = True
+    else:
+        device = 'cpu'
     print(f'Using {device}')
     
+    # Normalize on device instead of per-sample in the DataLoader workers
+    mean = torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225], device=device).view(1, 3, 1, 1)
+    
+    # Load Dataset
+    if opt.preload:
+        assert not distributed, '--preload does not support distributed training'
+        train_sampler = None
+        train_loader = DeviceLoader(train_set, opt.train_batch_size, device, shuffle=True, hflip=False)
+        test_loader = DeviceLoader(test_set, opt.test_batch_size, device, shuffle=False)
+    else:
+        loader_kwargs = {'num_workers': opt.num_workers, 'pin_memory': device != 'cpu'}
+        if opt.num_workers > 0:
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+        train_sampler = DistributedSampler(train_set) if distributed else None
+        train_loader = DataLoader(train_set, batch_size=opt.train_batch_size, shuffle=(train_sampler is None),
+                                  sampler=train_sampler, **loader_kwargs)
+        test_loader = DataLoader(test_set, batch_size=opt.test_batch_size, shuffle=False, **loader_kwargs)
+
+     
     # model
     from torchvision.models import vgg16_bn
     print(f'Preparing Model....{opt.model}')
     model = get_model(opt.model, opt.num_classes, pretrained=opt.pretrained)
-    model.to(device)
+    model = model.to(device, memory_format=torch.channels_last)
     
     # resuming
     if opt.resume:
         print('Resuming from checkpoint')
         assert os.path.isdir(f'{opt.resume}')
         
-        checkpoint = torch.load(f'{opt.resume}/{opt.model}_ckpt.pth')
+        checkpoint = torch.load(f'{opt.resume}/{opt.model}_ckpt.pth', map_location=device)
         model.load_state_dict(checkpoint['model'])
         
         best_acc = checkpoint['acc']
@@ -195,39 +255,62 @@ def main(opt):
         best_acc = 0
         train_result, test_result = [], [] 
         
+    model_without_ddp = model
+    if distributed:
+        model = DDP(model, device_ids=[local_rank])
+    if opt.compile:
+        assert hasattr(torch, 'compile'), 'torch.compile requires PyTorch 2.0 or later'
+        model = torch.compile(model, mode='max-autotune')
         
     # optmizer
     loss_func = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(model.parameters(), lr=opt.lr, weight_decay=0.0001)
+    optimizer = optim.Adam(model.parameters(), lr=opt.lr, weight_decay=0.0001,
+                           **fast_optim_kwargs(optim.Adam, device))
     scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=20, gamma=0.5)
+    scaler = GradScaler(enabled=opt.amp)
     
     # Training
     start = time.time()
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    save_future = None
     
     for e in range(start_epoch, start_epoch+opt.epoch):
-        train_result += train(model, train_loader, optimizer, loss_func, device, start_epoch, scheduler, e)
-        test_result += test(model, test_loader, loss_func, device, start_epoch, e)
+        if train_sampler is not None:
+            train_sampler.set_epoch(e)
+        train_result += train(model, train_loader, optimizer, scaler, loss_func, device, mean, std, start_epoch, scheduler, e)
+        test_result += test(model, test_loader, loss_func, device, mean, std, start_epoch, e)
         scheduler.step()
         
         # Save checkpoint
-        if test_result[1::2][-1] > best_acc:
+        if is_main and test_result[1::2][-1] > best_acc:
             print(f'Saving Model....({result_path})')
+            # snapshot to CPU so training can keep updating the weights while the file is written
             state = {
-                'model': model.state_dict(),
+                'model': {k: v.to('cpu', copy=True) for k, v in model_without_ddp.state_dict().items()},
                 'epoch': e+1,
                 'acc': test_result[1::2][-1],
-                'train_result': train_result,
-                'test_result': test_result
+                'train_result': list(train_result),
+                'test_result': list(test_result)
             }
-            torch.save(state, f'{result_path}/{opt.model}_ckpt.pth')
+            if save_future is not None:
+                save_future.result()
+            save_future = save_executor.submit(torch.save, state, f'{result_path}/{opt.model}_ckpt.pth')
             best = test_result[1::2][-1]
             
         # Save Result
-        if opt.save_result:
+        if is_main and opt.save_result:
             print(f'Saving Result....({result_path})')
             save_result(train_result, test_result, result_path)
             
+    if save_future is not None:
+        save_future.result()
+    save_executor.shutdown()
     end = time.time()
+    if distributed:
+        dist.destroy_process_group()
+    if not is_main:
+        return
+    
     with open(f'{result_path}/time_log.txt', 'w') as f:
         f.write(str(datetime.timedelta(seconds=end-start)))
         f.close()
@@ -1,4 +1,5 @@
 import os
+import inspect
 
 import matplotlib.pyplot as plt
 
@@ -42,4 +43,14 @@ def make_folder(base_path, folder):
         os.mkdir(new_folder)
         
     return new_folder
-    
\ No newline at end of file
+
+
+def fast_optim_kwargs(optim_cls, device):
+    # fused (single kernel, CUDA only) > foreach (multi-tensor) > default per-parameter loop
+    params = inspect.signature(optim_cls).parameters
+    if 'fused' in params and device != 'cpu':
+        return {'fused': True}
+    if 'foreach' in params:
+        return {'foreach': True}
+    
+    return {}
@@ -1,9 +1,11 @@
 import os
 from random import sample
+from collections import OrderedDict
 
 import torch
 from torch.utils.data import Dataset
 from torchvision.datasets import CocoDetection
+from torchvision.io import read_file, decode_jpeg, ImageReadMode
 import torchvision.transforms as transforms
 
 from pycocotools.coco import COCO
@@ -16,60 +18,52 @@ import numpy as np
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 
+
+def get_valid_ids(coco, ids):
+    # drop images without objects or with any bbox width/height <= 1,
+    # checked over every annotation at once
+    anns = list(coco.anns.values())
+    ann_img_ids = np.array([ann['image_id'] for ann in anns], dtype=np.int64)
+    bboxes = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)
+    invalid = (bboxes[:, 2] <= 1) | (bboxes[:, 3] <= 1)
+    
+    with_anno = set(np.unique(ann_img_ids).tolist())
+    with_invalid = set(np.unique(ann_img_ids[invalid]).tolist())
+    return [img_id for img_id in ids if img_id in with_anno and img_id not in with_invalid]
+
+
 class MyCocoDetection(CocoDetection):
     def __init__(
-        self, root, annFile, transform, remove_invalid_data=True, show=False
+        self, root, annFile, transform, remove_invalid_data=True, show=False, cache_size=0,
+        decode_device=None
     ):
-        super(myCocoDetection, self).__init__(root, annFile)
+        super(MyCocoDetection, self).__init__(root, annFile)
         
         # self.coco = COCO(annFile)
         # self.ids = list(sorted(self.coco.imgs.keys()))
         if remove_invalid_data:
-            ids = []
-            for img_id in self.ids:
-                ann_ids = self.coco.getAnnIds(imgIds=img_id)
-                anno = self.coco.loadAnns(ann_ids)
-                # print(len(anno))
-                if self.is_valid_data(anno):
-                    ids.append(img_id)
-            self.ids = ids
+            self.ids = get_valid_ids(self.coco, self.ids)
             
         self.transform = transform
         self.show = show
+        self.cache_size = cache_size
+        self._image_cache = OrderedDict()
+        self.decode_device = decode_device
         
-    # 물체가 없거나 bbox가 1보다 작은 경우 제외
-    def is_valid_data(self, anno):
-        if len(anno) == 0:
-            return False
-        for obj in anno:
-            for o in obj['bbox'][2:]:
-                if o <= 1:
-                    return False
-        return True
-            
     
     def __getitem__(self, index: int):
         idx = self.ids[index]
         image = self._load_image(idx)
         target = self._load_target(idx)
         
-        bboxes, labels = [], []
-        for obj in target:
-            xmin = obj['bbox'][0]
-            ymin = obj['bbox'][1]
-            xmax = obj['bbox'][0] + obj['bbox'][2]
-            ymax = obj['bbox'][1] + obj['bbox'][3]
-            bboxes.append([xmin, ymin, xmax, ymax])
-            labels.append(obj['category_id'])
-            
-        bboxes = np.array(bboxes, dtype=np.float32)
-        labels = np.array(labels, dtype=np.int64)
+        raw = np.array([obj['bbox'] for obj in target], dtype=np.float32).reshape(-1, 4)
+        bboxes = np.concatenate([raw[:, :2], raw[:, :2] + raw[:, 2:]], axis=1)
+        labels = np.fromiter((obj['category_id'] for obj in target), dtype=np.int64, count=len(target))
                 
         if self.transform:
-            
-            
-            
-            image = self.transform(image)
+            # images from _decode_image are already tensors
+            if self.decode_device is None:
+                image = self.transform(image)
             bboxes = self.transform(np.array(bboxes)).reshape(-1, 4)
             
             targets ={}
@@ -82,73 +76,77 @@ class MyCocoDetection(CocoDetection):
             
         return image, bboxes, labels
     
+    def _read_image(self, id):
+        # decoded RGB array, kept in a per-worker LRU when cache_size > 0
+        if id in self._image_cache:
+            self._image_cache.move_to_end(id)
+            return self._image_cache[id]
+        
+        path = self.coco.loadImgs(id)[0]["file_name"]
+        image = np.asarray(Image.open(os.path.join(self.root, path)).convert("RGB"))
+        if self.cache_size > 0:
+            self._image_cache[id] = image
+            if len(self._image_cache) > self.cache_size:
+                self._image_cache.popitem(last=False)
+        return image
+    
+    def _decode_image(self, id):
+        # libjpeg-turbo on cpu, nvjpeg on cuda (main process only, num_workers=0);
+        # returns the same float CHW tensor in [0, 1] as ToTensor
+        path = self.coco.loadImgs(id)[0]["file_name"]
+        data = read_file(os.path.join(self.root, path))
+        image = decode_jpeg(data, mode=ImageReadMode.RGB, device=self.decode_device)
+        return image.float().div(255)
+    
     def _load_image(self, id):
+        if self.decode_device is not None:
+            return self._decode_image(id)
+        if self.cache_size > 0:
+            return Image.fromarray(self._read_image(id))
         path = self.coco.loadImgs(id)[0]["file_name"]
         return Image.open(os.path.join(self.root, path)).convert("RGB")
 
     def _load_target(self, id):
-        return self.coco.loadAnns(self.coco.getAnnIds(id))
+        return self.coco.imgToAnns.get(id, [])
 
 
 # Specific Classes
 class MyCocoLimit(CocoDetection):
     def __init__(
-        self, root, annFile, transform, class_list, remove_invalid_data=True, show=False
+        self, root, annFile, transform, class_list, remove_invalid_data=True, show=False, cache_size=0
     ):
         super(MyCocoLimit, self).__init__(root, annFile)
         
         self.class_list = class_list
         self.catIds = self.coco.getCatIds(catNms=self.class_list)
-        self.new_cls_ids, self.ids = {}, []
-        for i, cls_id in enumerate(sorted(self.catIds)):
-            self.new_cls_ids[cls_id] = i + 1
-            self.ids.extend(self.coco.getImgIds(catIds=cls_id))
+        self.new_cls_ids = {cls_id: i + 1 for i, cls_id in enumerate(sorted(self.catIds))}
+        # an image containing several of the requested classes is kept only once
+        self.ids = sorted({img_id for cls_id in self.catIds for img_id in self.coco.getImgIds(catIds=cls_id)})
 
         if remove_invalid_data:
-            ids = []
-            for img_id in self.ids:
-                ann_ids = self.coco.getAnnIds(imgIds=img_id)
-                anno = self.coco.loadAnns(ann_ids)
-                # print(len(anno))
-                if self.is_valid_data(anno):
-                    ids.append(img_id)
-            self.ids = ids
+            self.ids = get_valid_ids(self.coco, self.ids)
             
         self.transform = transform
         self.show = show
+        self.cache_size = cache_size
+        self._image_cache = OrderedDict()
         
-    # 물체가 없거나 bbox가 1보다 작은 경우 제외
-    def is_valid_data(self, anno):
-        if len(anno) == 0:
-            return False
-        for obj in anno:
-            for o in obj['bbox'][2:]:
-                if o <= 1:
-                    return False
-        return True
-            
     
     def __getitem__(self, index: int):
         idx = self.ids[index]
-        image = self._load_image(idx)
         target = self._load_target(idx)
         
-        bboxes, labels = [], []
-        for obj in target:
-            xmin = obj['bbox'][0]
-            ymin = obj['bbox'][1]
-            xmax = obj['bbox'][0] + obj['bbox'][2]
-            ymax = obj['bbox'][1] + obj['bbox'][3]
-            bboxes.append([xmin, ymin, xmax, ymax])
-            labels.append(obj['category_id'])
-            
-        bboxes = np.array(bboxes, dtype=np.float32)
-        labels = np.array(labels, dtype=np.int64)
+        raw = np.array([obj['bbox'] for obj in target], dtype=np.float32).reshape(-1, 4)
+        bboxes = np.concatenate([raw[:, :2], raw[:, :2] + raw[:, 2:]], axis=1)
+        labels = np.fromiter((obj['category_id'] for obj in target), dtype=np.int64, count=len(target))
         
         if self.transform:
-            augmentations = self.transform(image=np.array(image), bboxes=bboxes, category_id=labels)
+            # albumentations takes the decoded array directly, without a PIL round trip
+            augmentations = self.transform(image=self._read_image(idx), bboxes=bboxes, category_id=labels)
             image = augmentations['image']
             bboxes = augmentations['bboxes']
+        else:
+            image = self._load_image(idx)
             
         boxes = torch.as_tensor(bboxes, dtype=torch.float32)
         labels = torch.as_tensor(labels, dtype=torch.int64)
@@ -164,12 +162,28 @@ class MyCocoLimit(CocoDetection):
                 
         return image, target
     
+    def _read_image(self, id):
+        # decoded RGB array, kept in a per-worker LRU when cache_size > 0
+        if id in self._image_cache:
+            self._image_cache.move_to_end(id)
+            return self._image_cache[id]
+        
+        path = self.coco.loadImgs(id)[0]["file_name"]
+        image = np.asarray(Image.open(os.path.join(self.root, path)).convert("RGB"))
+        if self.cache_size > 0:
+            self._image_cache[id] = image
+            if len(self._image_cache) > self.cache_size:
+                self._image_cache.popitem(last=False)
+        return image
+    
     def _load_image(self, id):
+        if self.cache_size > 0:
+            return Image.fromarray(self._read_image(id))
         path = self.coco.loadImgs(id)[0]["file_name"]
         return Image.open(os.path.join(self.root, path)).convert("RGB")
 
     def _load_target(self, id):
-        original = self.coco.loadAnns(self.coco.getAnnIds(id))
+        original = self.coco.imgToAnns.get(id, [])
         new = [ann for ann in original if ann['category_id'] in self.catIds]
         return new
     
@@ -34,15 +34,15 @@ def parse_opt():
     parser.add_argument('--model', help='Model Name', default='resnet18', type=str)
     parser.add_argument('--in_channels', help='Channels of input Image', default=3, type=int)
     parser.add_argument('--num_classes', help='Number of Classes', default=10, type=int)
-    parser.add_argument('--batch_norm', help='Using Batch Normalization', default=False, type=bool)
+    parser.add_argument('--batch_norm', help='Using Batch Normalization', default=False, action=argparse.BooleanOptionalAction)
     parser.add_argument('--train_batch_size', help='Batch size of Training dataset', default=256, type=int)
     parser.add_argument('--test_batch_size', help='Batch size of Testing dataset', default=128, type=int)
     parser.add_argument('--epoch', help='Size of Epoch', default=20, type=int)
     parser.add_argument('--lr', help='Learning Rate', default=0.01, type=float)
     parser.add_argument('--momentum', help='Momentum', default=0.9, type=float)
-    parser.add_argument('--cuda', help='Using GPU', default=True, type=bool)
+    parser.add_argument('--cuda', help='Using GPU', default=True, action=argparse.BooleanOptionalAction)
     parser.add_argument('--resume', help='Start from checkpoint', default='', type=str)
-    parser.add_argument('--save_result', help='Save Result of Train&Test', default=True, type=bool)
+    parser.add_argument('--save_result', help='Save Result of Train&Test', default=True, action=argparse.BooleanOptionalAction)
     parser.add_argument('--save_folder', help='Directory of Saving weight', default='train0', type=str)
     opt = parser.parse_args()
     
@@ -57,10 +57,11 @@ def coco2pascal(bboxes):
     
 def train(model, dataloader, optimizer, device, EPOCH, e):
     model.train()
-    iter_loss = []
+    loss_sum = torch.zeros((), device=device)
     data_size = 0
     times = 0
         
+    n_iter = len(dataloader)
     for i, (idx, images, targets) in enumerate(dataloader):
         start = time.time()
         
@@ -78,15 +79,15 @@ def train(model, dataloader, optimizer, device, EPOCH, e):
         loss.backward()
         optimizer.step()
         
-        iter_loss.append(loss.item())
+        loss_sum += loss.detach()
         
         end = time.time()
-        if ((i+1) % 200 == 0) or ((i+1) == len(dataloader)):
-            times = (end-start)*200 if not (i+1) == len(dataloader) else (end-start)*(i+1)
+        if ((i+1) % 200 == 0) or ((i+1) == n_iter):
+            times = (end-start)*200 if not (i+1) == n_iter else (end-start)*(i+1)
             
             print(f'EPOCH: [{e}/{EPOCH}]' \
-                  f' --- Iter: [{i+1}/{len(dataloader)}]'\
-                  f' --- Loss: {sum(iter_loss)/data_size:0.4f}'\
+                  f' --- Iter: [{i+1}/{n_iter}]'\
+                  f' --- Loss: {loss_sum.item()/data_size:0.4f}'\
                   f' --- Time: {strftime("%H:%M:%S", gmtime(times))}'\
                   f' --- LR: ')
 
@@ -7,6 +7,20 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import numpy as np
 
+
+def get_valid_ids(coco, ids):
+    # drop images without objects or with any bbox width/height <= 1,
+    # checked over every annotation at once
+    anns = list(coco.anns.values())
+    ann_img_ids = np.array([ann['image_id'] for ann in anns], dtype=np.int64)
+    bboxes = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)
+    invalid = (bboxes[:, 2] <= 1) | (bboxes[:, 3] <= 1)
+    
+    with_anno = set(np.unique(ann_img_ids).tolist())
+    with_invalid = set(np.unique(ann_img_ids[invalid]).tolist())
+    return [img_id for img_id in ids if img_id in with_anno and img_id not in with_invalid]
+
+
 class myCocoDetection(CocoDetection):
     def __init__(
         self, root, annFile, transform, remove_invalid_data=True, show=False
@@ -14,40 +28,20 @@ class myCocoDetection(CocoDetection):
         super(myCocoDetection, self).__init__(root, annFile)
                
         if remove_invalid_data:
-            ids = []
-            for img_id in self.ids:
-                ann_ids = self.coco.getAnnIds(imgIds=img_id)
-                anno = self.coco.loadAnns(ann_ids)
-                if self.is_valid_data(anno):
-                    ids.append(img_id)
-            self.ids = ids
+            self.ids = get_valid_ids(self.coco, self.ids)
             
         self.transform = transform
         self.show = show
         
-    def is_valid_data(self, anno):
-        if len(anno) == 0:
-            return False
-        for obj in anno:
-            for o in obj['bbox'][2:]:
-                if o <= 1:
-                    return False
-        return True
-            
     
     def __getitem__(self, index: int):
         idx = self.ids[index]
         image = self._load_image(idx)
         target = self._load_target(idx)
         
-        bboxes, labels = [], []
-        for obj in target:
-            bbox = [obj['bbox'][0],
-                    obj['bbox'][1],
-                    obj['bbox'][0] + obj['bbox'][2],
-                    obj['bbox'][1] + obj['bbox'][3]]
-            bboxes.append(bbox)
-            labels.append(obj['category_id'])
+        raw = np.array([obj['bbox'] for obj in target], dtype=np.float32).reshape(-1, 4)
+        bboxes = np.concatenate([raw[:, :2], raw[:, :2] + raw[:, 2:]], axis=1)
+        labels = np.fromiter((obj['category_id'] for obj in target), dtype=np.int64, count=len(target))
             
         if self.show:
             return image, bboxes, labels
@@ -65,6 +59,9 @@ class myCocoDetection(CocoDetection):
             return idx, image, targets        
             
         return image, bboxes, labels
+    
+    def _load_target(self, id):
+        return self.coco.imgToAnns.get(id, [])
 
 
 
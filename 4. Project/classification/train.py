@@ -4,10 +4,12 @@ from time import strftime, gmtime
 import datetime
 import argparse
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from torch.cuda.amp import autocast, GradScaler
 from torch.utils.data import DataLoader, Subset
 import torchvision
 import torchvision.transforms as transforms
@@ -21,7 +23,7 @@ import matplotlib.pyplot as plt
 # from model import ResNet, Bottleneck, BasicBlock
 from models import get_model
 from dataset import get_dataset
-from utils import save_result, make_folder
+from utils import save_result, make_folder, fast_optim_kwargs
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -39,15 +41,17 @@ def parse_opt():
     parser.add_argument('--in_channels', help='Channels of input Image', default=3, type=int)
     parser.add_argument('--num_classes', help='Number of Classes', default=10, type=int)
     parser.add_argument('--pretrained', help='Transfer Learning', action='store_true')
-    parser.add_argument('--batch_norm', help='Using Batch Normalization', default=False, type=bool)
+    parser.add_argument('--batch_norm', help='Using Batch Normalization', default=False, action=argparse.BooleanOptionalAction)
     parser.add_argument('--train_batch_size', help='Batch size of Training dataset', default=256, type=int)
     parser.add_argument('--test_batch_size', help='Batch size of Testing dataset', default=128, type=int)
+    parser.add_argument('--num_workers', help='Number of DataLoader workers', default=8, type=int)
     parser.add_argument('--epoch', help='Size of Epoch', default=20, type=int)
     parser.add_argument('--lr', help='Learning Rate', default=0.01, type=float)
     parser.add_argument('--momentum', help='Momentum', default=0.9, type=float)
-    parser.add_argument('--cuda', help='Using GPU', default=True, type=bool)
+    parser.add_argument('--cuda', help='Using GPU', default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument('--amp', help='Mixed Precision Training', action='store_true')
     parser.add_argument('--resume', help='Start from checkpoint', default='', type=str)
-    parser.add_argument('--save_result', help='Save Result of Train&Test', default=True, type=bool)
+    parser.add_argument('--save_result', help='Save Result of Train&Test', default=True, action=argparse.BooleanOptionalAction)
     parser.add_argument('--save_folder', help='Directory of Saving weight', default='train0', type=str)
     parser.add_argument('--testing', help='Testing Code', action='store_true')
     opt = parser.parse_args()
@@ -55,11 +59,11 @@ def parse_opt():
     return opt
 
 
-def train(model, dataloader, optimizer, loss_func, device, start_epoch, scheduler, e):
+def train(model, dataloader, optimizer, scaler, loss_func, device, start_epoch, scheduler, e):
     print(f'EPOCH[{e+1}/{start_epoch+opt.epoch}] Training....')
     model.train()
-    iter_loss = []
-    corrects = 0
+    loss_sum = torch.zeros((), device=device)
+    correct_sum = torch.zeros((), device=device, dtype=torch.long)
     data_size = 0
     
     train_acc1 = torchmetrics.Accuracy(num_classes=opt.num_classes).to(device)
@@ -67,32 +71,36 @@ def train(model, dataloader, optimizer, loss_func, device, start_epoch, schedule
     # train_precision = torchmetrics.Precision(num_classes=10, multiclass=True).to(device)
     # train_recall = torchmetrics.Recall(num_classes=10, multiclass=True).to(device)
     
+    n_iter = len(dataloader)
     for i, (images, labels) in enumerate(dataloader):
         start = time.time()
         
-        images, labels = images.to(device), labels.to(device)
+        images = images.to(device, non_blocking=True, memory_format=torch.channels_last)
+        labels = labels.to(device, non_blocking=True)
         data_size += images.shape[0]
         
-        optimizer.zero_grad()
-        outputs = model(images)
-        loss = loss_func(outputs, labels)
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        with autocast(enabled=opt.amp):
+            outputs = model(images)
+            loss = loss_func(outputs, labels)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         train_acc1(outputs, labels)
         # train_acc5(outputs, labels)
         # train_precision(outputs, labels)
         # train_recall(outputs, labels)
 
-        iter_loss.append(loss.item())
-        corrects += sum(outputs.argmax(axis=1) == labels).item()
+        loss_sum += loss.detach()
+        correct_sum += (outputs.argmax(1) == labels).sum()
 
         end = time.time()
-        if ((i+1) % 40 == 0) or ((i+1) == len(dataloader)) :
-            times = (end-start)*40 if not (i+1) == len(dataloader) else (end-start)*i
-            print(f'Iter[{i+1}/{len(dataloader)}]'\
-                  f'--- Loss: {sum(iter_loss)/data_size:0.4f}'\
-                #   f' --- Accuracy: {corrects/data_size:0.2f}'\
+        if ((i+1) % 40 == 0) or ((i+1) == n_iter) :
+            times = (end-start)*40 if not (i+1) == n_iter else (end-start)*i
+            print(f'Iter[{i+1}/{n_iter}]'\
+                  f'--- Loss: {loss_sum.item()/data_size:0.4f}'\
+                #   f' --- Accuracy: {correct_sum.item()/data_size:0.2f}'\
                   f' --- Accuracy1: {train_acc1.compute():0.2f}'\
                 #   f' --- Accuracy5: {train_acc5.compute():0.2f}'\
                 #   f' --- Precision: {train_precision.compute():0.2f}'\
@@ -100,38 +108,41 @@ def train(model, dataloader, optimizer, loss_func, device, start_epoch, schedule
                   f'--- Time:{strftime("%H:%M:%S", gmtime(times))}'\
                   f'--- LR: {scheduler.get_lr()[0]:0.4f}')
             
-    return [sum(iter_loss)/data_size, train_acc1.compute().cpu()]
+    return [loss_sum.item()/data_size, train_acc1.compute().cpu()]
 
 
 
 def test(model, dataloader, loss_func, device, start_epoch, e):
     print(f'EPOCH[{e+1}/{start_epoch+opt.epoch}] Teseting....')
     model.eval()
-    iter_loss = []
-    corrects = 0
+    loss_sum = torch.zeros((), device=device)
+    correct_sum = torch.zeros((), device=device, dtype=torch.long)
     
     test_metrics = torchmetrics.Accuracy(num_classes=opt.num_classes).to(device)
     
-    with torch.no_grad():
+    n_iter = len(dataloader)
+    with torch.inference_mode():
         data_size = 0
         for i, (images, labels) in enumerate(dataloader):
-            images, labels = images.to(device), labels.to(device)
+            images = images.to(device, non_blocking=True, memory_format=torch.channels_last)
+            labels = labels.to(device, non_blocking=True)
             data_size += images.shape[0]
             
-            outputs = model(images)
-            loss = loss_func(outputs, labels)
+            with autocast(enabled=opt.amp):
+                outputs = model(images)
+                loss = loss_func(outputs, labels)
             
             test_metrics(outputs, labels)
             
-            iter_loss.append(loss.item())
-            corrects += sum(outputs.argmax(axis=1) == labels).item()
+            loss_sum += loss.detach()
+            correct_sum += (outputs.argmax(1) == labels).sum()
     
-    print(f'Iter[{i+1}/{len(dataloader)}]' \
-          f'--- Loss: {sum(iter_loss)/data_size:0.4}'\
-        #   f'--- Accuracy: {corrects/data_size:0.2}'\
+    print(f'Iter[{i+1}/{n_iter}]' \
+          f'--- Loss: {loss_sum.item()/data_size:0.4}'\
+        #   f'--- Accuracy: {correct_sum.item()/data_size:0.2}'\
           f'--- Accuracy: {test_metrics.compute():0.4f}')
     
-    return [sum(iter_loss)/data_size, test_metrics.compute().cpu()]
+    return [loss_sum.item()/data_size, test_metrics.compute().cpu()]
             
         
 def main(opt):
@@ -161,20 +172,27 @@ def main(opt):
         train_set = Subset(train_set, range(opt.train_batch_size))
         test_set = Subset(test_set, range(opt.test_batch_size))
     
-    # Load Dataset
-    train_loader = DataLoader(train_set, batch_size=opt.train_batch_size, shuffle=True)
-    test_loader = DataLoader(test_set, batch_size=opt.test_batch_size, shuffle=False)
-
-     
     # GPU
-    device = 'cuda' if (torch.cuda.is_available() and opt.cuda) else 'cpu'
+    if torch.cuda.is_available() and opt.cuda:
+        device = 'cuda'
+        torch.backends.cudnn.benchmark = True
+    else:
+        device = 'cpu'
     print(f'Using {device}')
     
+    # Load Dataset
+    loader_kwargs = {'num_workers': opt.num_workers, 'pin_memory': device != 'cpu'}
+    if opt.num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    train_loader = DataLoader(train_set, batch_size=opt.train_batch_size, shuffle=True, **loader_kwargs)
+    test_loader = DataLoader(test_set, batch_size=opt.test_batch_size, shuffle=False, **loader_kwargs)
+
+    
     # model
     from torchvision.models import vgg16_bn
     print(f'Preparing Model....{opt.model}')
     model = get_model(opt.model, opt.num_classes, pretrained=opt.pretrained)
-    model.to(device)
+    model = model.to(device, memory_format=torch.channels_last)
     
     # resuming
     if opt.resume:
@@ -197,28 +215,35 @@ def main(opt):
         
     # optmizer
     loss_func = nn.CrossEntropyLoss()
-    optimizer = optim.SGD(model.parameters(), lr=opt.lr, momentum=opt.momentum)
+    optimizer = optim.SGD(model.parameters(), lr=opt.lr, momentum=opt.momentum,
+                          **fast_optim_kwargs(optim.SGD, device))
     scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=5, gamma=0.5)
+    scaler = GradScaler(enabled=opt.amp)
     
     # Training
     start = time.time()
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    save_future = None
     
     for e in range(start_epoch, start_epoch+opt.epoch):
-        train_result += train(model, train_loader, optimizer, loss_func, device, start_epoch, scheduler, e)
+        train_result += train(model, train_loader, optimizer, scaler, loss_func, device, start_epoch, scheduler, e)
         test_result += test(model, test_loader, loss_func, device, start_epoch, e)
         scheduler.step()
         
         # Save checkpoint
         if test_result[1::2][-1] > best_acc:
             print(f'Saving Model....({result_path})')
+            # snapshot to CPU so training can keep updating the weights while the file is written
             state = {
-                'model': model.state_dict(),
+                'model': {k: v.to('cpu', copy=True) for k, v in model.state_dict().items()},
                 'epoch': e+1,
                 'acc': test_result[1::2][-1],
-                'train_result': train_result,
-                'test_result': test_result
+                'train_result': list(train_result),
+                'test_result': list(test_result)
             }
-            torch.save(state, f'{result_path}/{opt.model}_ckpt.pth')
+            if save_future is not None:
+                save_future.result()
+            save_future = save_executor.submit(torch.save, state, f'{result_path}/{opt.model}_ckpt.pth')
             best = test_result[1::2][-1]
             
         # Save Result
@@ -226,6 +251,9 @@ def main(opt):
             print(f'Saving Result....({result_path})')
             save_result(train_result, test_result, result_path)
             
+    if save_future is not None:
+        save_future.result()
+    save_executor.shutdown()
     end = time.time()
     with open(f'{result_path}/time_log.txt', 'w') as f:
         f.write(str(datetime.timedelta(seconds=end-start)))